@@ -20,6 +20,10 @@ from dotenv import load_dotenv
 import firebase_admin
 from firebase_admin import credentials, firestore
 
+from demand_forecast import DemandForecaster
+from significance import SignificanceEngine
+from normalize import normalize_rows
+
 # Load environment variables
 load_dotenv()
 
@@ -34,11 +38,12 @@ logger = logging.getLogger(__name__)
 class AnalyticsBridge:
     """Main class for data processing and analysis"""
     
-    def __init__(self):
+    def __init__(self, n_resamples: int = 2000, seed: int = 42, workers: int = 1):
         self.db = None
         self.sales_data: pd.DataFrame = None
         self.market_data: pd.DataFrame = None
         self.processed_stats: pd.DataFrame = None
+        self.significance = SignificanceEngine(n_resamples=n_resamples, seed=seed, workers=workers)
         
     def initialize_firebase(self) -> bool:
         """Initialize Firebase Admin SDK with credentials"""
@@ -78,20 +83,32 @@ class AnalyticsBridge:
             logger.error(f"Failed to initialize Firebase: {str(e)}")
             return False
     
+    def _fetch_since(self, collection_name: str, cutoff_date: datetime) -> List[Dict[str, Any]]:
+        """
+        Fetch documents dated on or after cutoff_date. Firestore range filters only
+        match values of the same type, so 'YYYY-MM-DD' string dates and Timestamp
+        dates are queried separately and combined.
+        """
+        collection_ref = self.db.collection(collection_name)
+        queries = [
+            collection_ref.where('date', '>=', cutoff_date.strftime('%Y-%m-%d')),
+            collection_ref.where('date', '>=', cutoff_date)
+        ]
+
+        data = []
+        for query in queries:
+            for doc in query.stream():
+                record = doc.to_dict()
+                record['id'] = doc.id
+                data.append(record)
+        return data
+
     def fetch_sales_data(self, days: int = 90) -> pd.DataFrame:
         """Fetch sales data from Firestore for the specified number of days"""
         try:
             cutoff_date = datetime.now() - timedelta(days=days)
             
-            sales_ref = self.db.collection('sales_data')
-            query = sales_ref.where('date', '>=', cutoff_date.strftime('%Y-%m-%d'))
-            docs = query.stream()
-            
-            data = []
-            for doc in docs:
-                record = doc.to_dict()
-                record['id'] = doc.id
-                data.append(record)
+            data = self._fetch_since('sales_data', cutoff_date)
             
             if not data:
                 logger.warning("No sales data found")
@@ -105,9 +122,11 @@ class AnalyticsBridge:
                 if col not in df.columns:
                     logger.warning(f"Missing column in sales data: {col}")
             
-            # Convert date to datetime
-            df['date'] = pd.to_datetime(df['date'], errors='coerce')
-            df['amount'] = pd.to_numeric(df['amount'], errors='coerce').fillna(0)
+            # Normalize dates (strings or Firestore Timestamps) and amounts
+            df, report = normalize_rows(df)
+            if report['rejected_dates'] or report['rejected_amounts']:
+                logger.warning(f"Rejected {report['rejected_dates']} sales rows with unparseable dates; "
+                               f"{report['rejected_amounts']} unparseable amounts set to 0")
             
             self.sales_data = df
             logger.info(f"Fetched {len(df)} sales records")
@@ -122,15 +141,7 @@ class AnalyticsBridge:
         try:
             cutoff_date = datetime.now() - timedelta(days=days)
             
-            market_ref = self.db.collection('market_historical_data')
-            query = market_ref.where('date', '>=', cutoff_date.strftime('%Y-%m-%d'))
-            docs = query.stream()
-            
-            data = []
-            for doc in docs:
-                record = doc.to_dict()
-                record['id'] = doc.id
-                data.append(record)
+            data = self._fetch_since('market_historical_data', cutoff_date)
             
             if not data:
                 logger.warning("No market data found")
@@ -144,9 +155,11 @@ class AnalyticsBridge:
                 if col not in df.columns:
                     logger.warning(f"Missing column in market data: {col}")
             
-            # Convert date to datetime
-            df['date'] = pd.to_datetime(df['date'], errors='coerce')
-            df['amount'] = pd.to_numeric(df['amount'], errors='coerce').fillna(0)
+            # Normalize dates (strings or Firestore Timestamps) and amounts
+            df, report = normalize_rows(df)
+            if report['rejected_dates'] or report['rejected_amounts']:
+                logger.warning(f"Rejected {report['rejected_dates']} market rows with unparseable dates; "
+                               f"{report['rejected_amounts']} unparseable amounts set to 0")
             
             self.market_data = df
             logger.info(f"Fetched {len(df)} market records")
@@ -225,6 +238,10 @@ class AnalyticsBridge:
             ingredient_cols = [col for col in joined_data.columns 
                              if col not in ['date', 'total_sales', 'transaction_count', 'items_sold']]
             
+            # Block bootstrap CIs and permutation p-values for all ingredients in one pass;
+            # pearsonr assumes independent normal days, which daily sales series are not
+            resampled = self.significance.run_frame(joined_data, 'total_sales', ingredient_cols)
+            
             for ingredient in ingredient_cols:
                 # Skip if no data for this ingredient
                 if joined_data[ingredient].isna().all():
@@ -270,18 +287,22 @@ class AnalyticsBridge:
                 sales_change = ((valid_data['total_sales'].iloc[-1] - valid_data['total_sales'].iloc[0]) 
                                / valid_data['total_sales'].iloc[0] * 100) if valid_data['total_sales'].iloc[0] != 0 else 0
                 
+                robust = resampled[ingredient]
+                
                 corr_data = {
                     'ingredient': ingredient,
                     'correlation_with_sales': round(corr_sales, 4),
                     'correlation_with_transactions': round(corr_txn, 4),
                     'p_value_sales': round(p_value_sales, 4),
                     'p_value_transactions': round(p_value_txn, 4),
+                    'p_value_sales_permutation': round(robust['p_value'], 4),
+                    'correlation_ci_sales': [round(robust['ci_low'], 4), round(robust['ci_high'], 4)],
                     'trend': trend,
                     'insight': insight,
                     'cost_change_percent': round(cost_change, 2),
                     'sales_change_percent': round(sales_change, 2),
                     'data_points': len(valid_data),
-                    'significant': p_value_sales < 0.05
+                    'significant': robust['p_value'] < 0.05
                 }
                 
                 correlations['ingredient_correlations'].append(corr_data)
@@ -322,6 +343,8 @@ class AnalyticsBridge:
                     'trend': trend_text,
                     'severity': 'high' if corr['cost_change_percent'] > 20 else 'medium',
                     'correlation_strength': abs(corr['correlation_with_sales']),
+                    'cost_change_percent': corr['cost_change_percent'],
+                    'sales_change_percent': corr['sales_change_percent'],
                     'action_needed': True
                 })
             
@@ -333,6 +356,8 @@ class AnalyticsBridge:
                     'trend': trend_text,
                     'severity': 'opportunity',
                     'correlation_strength': abs(corr['correlation_with_sales']),
+                    'cost_change_percent': corr['cost_change_percent'],
+                    'sales_change_percent': corr['sales_change_percent'],
                     'action_needed': True
                 })
         
@@ -425,6 +450,10 @@ class AnalyticsBridge:
         
         # Save results
         if self.save_processed_stats(correlations, trends):
+            # Forecast menu item demand for the predictive charts
+            if not DemandForecaster(self.db).run(self.sales_data):
+                logger.warning("Demand forecast failed; prediction_history not updated")
+            
             logger.info("Analysis completed successfully")
             return True
         else:
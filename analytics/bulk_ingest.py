@@ -0,0 +1,380 @@
+#!/usr/bin/env python3
+"""
+Bulk Ingest - Phase 1 (server side)
+High-throughput CSV ingestion into sales_data / market_historical_data.
+Reads CSV files in chunks, applies the same field mapping and date/amount
+normalization as the dashboard uploader, and writes through a rate-limited
+Firestore BulkWriter with per-chunk checkpoints so interrupted imports resume
+from the last committed row.
+"""
+
+import os
+import json
+import hashlib
+import logging
+import argparse
+import threading
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+import pandas as pd
+from dotenv import load_dotenv
+
+from firebase_admin import firestore
+from google.cloud.firestore_v1.bulk_writer import BulkWriterOptions, BulkWriteFailure
+
+from analytics_bridge import AnalyticsBridge
+from normalize import parse_dates, clean_amounts, numeric_date_evidence, choose_day_first
+
+load_dotenv()
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+# Mirrors requiredFields in public/js/app.js
+REQUIRED_FIELDS = {
+    'sales': [
+        {'key': 'date', 'label': 'Date', 'type': 'date'},
+        {'key': 'amount', 'label': 'Amount', 'type': 'number'},
+        {'key': 'itemName', 'label': 'Item Name', 'type': 'string'},
+        {'key': 'orderNumber', 'label': 'Order Number', 'type': 'string'}
+    ],
+    'market': [
+        {'key': 'date', 'label': 'Date', 'type': 'date'},
+        {'key': 'amount', 'label': 'Amount', 'type': 'number'},
+        {'key': 'ingredientName', 'label': 'Ingredient Name', 'type': 'string'}
+    ]
+}
+
+COLLECTIONS = {
+    'sales': 'sales_data',
+    'market': 'market_historical_data'
+}
+
+# Attempts per document before a write failure is reported
+MAX_WRITE_ATTEMPTS = 5
+
+# gRPC status codes worth retrying: CANCELLED, DEADLINE_EXCEEDED, RESOURCE_EXHAUSTED,
+# ABORTED, INTERNAL, UNAVAILABLE. Anything else (e.g. INVALID_ARGUMENT) fails immediately.
+RETRYABLE_CODES = {1, 4, 8, 10, 13, 14}
+
+
+def format_dates(values: pd.Series, day_first: Optional[bool] = None) -> Tuple[pd.Series, int]:
+    """
+    Normalize dates to the YYYY-MM-DD strings formatDate in public/js/app.js stores.
+    day_first fixes the NN/NN/YYYY field order for the whole file.
+    Returns (dates, number of unparseable values); unparseable dates become None.
+    """
+    parsed, rejected = parse_dates(values.replace('', None), day_first)
+    formatted = parsed.dt.strftime('%Y-%m-%d')
+    return formatted.where(parsed.notna(), None), rejected
+
+
+def format_amounts(values: pd.Series) -> Tuple[pd.Series, int]:
+    """
+    Normalize amounts like formatAmount in public/js/app.js: strip non-numeric characters, default 0.
+    Returns (amounts, number of non-empty values that could not be parsed).
+    """
+    return clean_amounts(values)
+
+
+def resolve_mapping(headers: List[str], data_type: str, overrides: Dict[str, str]) -> Dict[str, str]:
+    """Map each required field to a CSV column, auto-matching names like the dashboard does"""
+    mapping = {}
+    for field in REQUIRED_FIELDS[data_type]:
+        if field['key'] in overrides:
+            mapping[field['key']] = overrides[field['key']]
+            continue
+        for header in headers:
+            lower = header.lower()
+            if field['key'].lower() in lower or field['label'].lower() in lower:
+                mapping[field['key']] = header
+                break
+
+    missing = [f['label'] for f in REQUIRED_FIELDS[data_type] if f['key'] not in mapping]
+    if missing:
+        raise ValueError(f"Please map all required fields: {', '.join(missing)}")
+
+    unknown = [col for col in mapping.values() if col not in headers]
+    if unknown:
+        raise ValueError(f"Mapped columns not found in CSV: {', '.join(unknown)}")
+
+    return mapping
+
+
+class BulkIngestor:
+    """Chunked, resumable CSV ingestion through a Firestore BulkWriter"""
+
+    def __init__(self, db, data_type: str, chunk_size: int = 5000,
+                 max_ops_per_second: int = 500, update_daily: bool = False):
+        self.db = db
+        self.data_type = data_type
+        self.collection_name = COLLECTIONS[data_type]
+        self.chunk_size = chunk_size
+        self.max_ops_per_second = max_ops_per_second
+        self.update_daily = update_daily
+        self._failures: List[BulkWriteFailure] = []
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def source_id(path: str) -> str:
+        """Stable identifier for a CSV file, used for document IDs and checkpoints"""
+        stat = os.stat(path)
+        key = f"{os.path.abspath(path)}:{stat.st_size}:{int(stat.st_mtime)}"
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+
+    @staticmethod
+    def checkpoint_path(path: str) -> str:
+        return f"{path}.ingest.json"
+
+    def load_checkpoint(self, path: str, source_id: str) -> Dict:
+        """Return the checkpoint recorded for this file, or an empty dict"""
+        cp_path = self.checkpoint_path(path)
+        if not os.path.exists(cp_path):
+            return {}
+
+        try:
+            with open(cp_path) as f:
+                checkpoint = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable checkpoint {cp_path}: {str(e)}")
+            return {}
+
+        if checkpoint.get('sourceId') != source_id or checkpoint.get('collection') != self.collection_name:
+            logger.warning(f"Checkpoint {cp_path} belongs to a different file or collection; starting over")
+            return {}
+
+        return checkpoint
+
+    def save_checkpoint(self, path: str, source_id: str, rows_committed: int,
+                        chunk_size: int, day_first: bool) -> None:
+        """Atomically record the committed rows and the chunk size and date order they were committed with"""
+        cp_path = self.checkpoint_path(path)
+        tmp_path = cp_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({
+                'sourceId': source_id,
+                'collection': self.collection_name,
+                'rowsCommitted': rows_committed,
+                'chunkSize': chunk_size,
+                'dayFirst': day_first
+            }, f)
+        os.replace(tmp_path, cp_path)
+
+    def detect_day_first(self, path: str, date_column: str) -> bool:
+        """
+        Decide the NN/NN/YYYY field order once for the whole file from a pass over
+        its date column, so every chunk is read the same way
+        """
+        first_over_12 = second_over_12 = False
+        for dates in pd.read_csv(path, usecols=[date_column], dtype=str, keep_default_na=False,
+                                 chunksize=max(self.chunk_size, 100000)):
+            first, second = numeric_date_evidence(dates[date_column].drop_duplicates())
+            first_over_12 |= first
+            second_over_12 |= second
+            if second_over_12:
+                # Month-first is settled once any second field exceeds 12
+                break
+        return choose_day_first(first_over_12, second_over_12)
+
+    def normalize_chunk(self, chunk: pd.DataFrame, mapping: Dict[str, str],
+                        day_first: Optional[bool] = None) -> Tuple[pd.DataFrame, Dict[str, int]]:
+        """Apply the field mapping and per-type normalization to one chunk; returns rejected counts by type"""
+        out = pd.DataFrame(index=chunk.index)
+        rejected = {'date': 0, 'number': 0}
+        for field in REQUIRED_FIELDS[self.data_type]:
+            column = chunk[mapping[field['key']]]
+            if field['type'] == 'date':
+                out[field['key']], count = format_dates(column, day_first)
+                rejected['date'] += count
+            elif field['type'] == 'number':
+                out[field['key']], count = format_amounts(column)
+                rejected['number'] += count
+            else:
+                out[field['key']] = column.fillna('').astype(str)
+        return out, rejected
+
+    def _on_write_error(self, failure: BulkWriteFailure, _writer) -> bool:
+        """Retry transient failures up to MAX_WRITE_ATTEMPTS, then record the failure"""
+        if failure.code in RETRYABLE_CODES and failure.attempts < MAX_WRITE_ATTEMPTS:
+            return True
+        with self._lock:
+            self._failures.append(failure)
+        return False
+
+    def _queue_daily_aggregates(self, writer, rows: pd.DataFrame, source_id: str, chunk_start: int) -> None:
+        """
+        Write this chunk's per-date totals to sales_daily as partial documents.
+        Each document is keyed by source file, chunk and date and written with a
+        plain set, so retries and resumed chunks overwrite instead of double counting;
+        ingest() pins the chunk size on resume so chunk boundaries never shift.
+        A date's total is the sum of the totalSales of its partial documents
+        (query sales_daily where date == 'YYYY-MM-DD').
+        """
+        daily = rows.dropna(subset=['date']).groupby('date').agg(
+            total=('amount', 'sum'),
+            count=('amount', 'size')
+        )
+        for date, agg in daily.iterrows():
+            writer.set(self.db.collection('sales_daily').document(f"{source_id}_{chunk_start}_{date}"), {
+                'date': date,
+                'totalSales': float(agg['total']),
+                'transactionCount': int(agg['count']),
+                'sourceId': source_id,
+                'chunkStart': chunk_start,
+                'updatedAt': firestore.SERVER_TIMESTAMP
+            })
+
+    def ingest(self, path: str, overrides: Optional[Dict[str, str]] = None) -> bool:
+        """Ingest one CSV file, resuming from its checkpoint if present"""
+        self._failures = []
+        try:
+            source_id = self.source_id(path)
+            headers = list(pd.read_csv(path, nrows=0).columns)
+        except (OSError, ValueError) as e:
+            logger.error(f"Error reading {path}: {str(e)}")
+            return False
+
+        try:
+            mapping = resolve_mapping(headers, self.data_type, overrides or {})
+        except ValueError as e:
+            logger.error(str(e))
+            return False
+
+        checkpoint = self.load_checkpoint(path, source_id)
+        start_row = int(checkpoint.get('rowsCommitted', 0))
+        # Resumed runs keep the original chunk size so sales_daily partials stay aligned
+        chunk_size = int(checkpoint.get('chunkSize', self.chunk_size)) if start_row else self.chunk_size
+        if start_row:
+            logger.info(f"Resuming {path} from row {start_row}")
+            if chunk_size != self.chunk_size:
+                logger.warning(f"Using chunk size {chunk_size} from the checkpoint instead of {self.chunk_size}")
+
+        # Resumed runs keep the original date order so earlier and later rows agree
+        if start_row and 'dayFirst' in checkpoint:
+            day_first = bool(checkpoint['dayFirst'])
+        else:
+            try:
+                day_first = self.detect_day_first(path, mapping['date'])
+            except (OSError, ValueError) as e:
+                logger.error(f"Error reading dates from {path}: {str(e)}")
+                return False
+        logger.info(f"Reading numeric dates in {path} as {'DD/MM/YYYY' if day_first else 'MM/DD/YYYY'}")
+
+        reader = pd.read_csv(
+            path,
+            usecols=list(set(mapping.values())),
+            dtype=str,
+            keep_default_na=False,
+            # A callable avoids materialising every skipped row index
+            skiprows=lambda i: 0 < i <= start_row,
+            chunksize=chunk_size
+        )
+
+        writer = self.db.bulk_writer(BulkWriterOptions(
+            initial_ops_per_second=min(500, self.max_ops_per_second),
+            max_ops_per_second=self.max_ops_per_second
+        ))
+        writer.on_write_error(self._on_write_error)
+
+        collection = self.db.collection(self.collection_name)
+        rows_committed = start_row
+        invalid_dates = 0
+        invalid_amounts = 0
+
+        try:
+            for chunk in reader:
+                rows, rejected = self.normalize_chunk(chunk, mapping, day_first)
+                invalid_dates += rejected['date']
+                invalid_amounts += rejected['number']
+
+                records = rows.replace({np.nan: None}).to_dict('records')
+                for offset, record in enumerate(records):
+                    # Row-derived IDs keep replays after a crash idempotent
+                    doc_ref = collection.document(f"{source_id}_{rows_committed + offset}")
+                    writer.set(doc_ref, {**record, 'createdAt': firestore.SERVER_TIMESTAMP})
+
+                if self.update_daily and self.data_type == 'sales':
+                    self._queue_daily_aggregates(writer, rows, source_id, rows_committed)
+
+                # Wait for the chunk to land before reading more: bounds memory and in-flight writes
+                writer.flush()
+                if self._failures:
+                    logger.error(f"{len(self._failures)} writes failed in chunk starting at row {rows_committed}: "
+                                 f"{self._failures[0].message}")
+                    return False
+
+                rows_committed += len(records)
+                self.save_checkpoint(path, source_id, rows_committed, chunk_size, day_first)
+                logger.info(f"Committed {rows_committed} rows to {self.collection_name}")
+
+        except Exception as e:
+            logger.error(f"Error ingesting {path}: {str(e)}")
+            return False
+
+        finally:
+            writer.close()
+
+        if invalid_dates:
+            logger.warning(f"{invalid_dates} rows had unparseable dates and were stored with date=None")
+        if invalid_amounts:
+            logger.warning(f"{invalid_amounts} rows had unparseable amounts and were stored with amount=0")
+
+        logger.info(f"Finished ingesting {path}: {rows_committed - start_row} new rows, {rows_committed} total")
+        return True
+
+
+def parse_mapping(pairs: List[str]) -> Dict[str, str]:
+    """Parse --map field=column arguments"""
+    mapping = {}
+    for pair in pairs:
+        field, sep, column = pair.partition('=')
+        if not sep:
+            raise argparse.ArgumentTypeError(f"Invalid mapping '{pair}', expected field=column")
+        mapping[field.strip()] = column.strip()
+    return mapping
+
+
+def main():
+    """Main entry point"""
+    parser = argparse.ArgumentParser(description='Bulk ingest CSV files into Firestore')
+    parser.add_argument('type', choices=sorted(COLLECTIONS), help='Data type to ingest')
+    parser.add_argument('files', nargs='+', help='CSV files to ingest')
+    parser.add_argument('--map', action='append', default=[], metavar='FIELD=COLUMN',
+                        help='Map a required field to a CSV column (repeatable)')
+    parser.add_argument('--chunk-size', type=int, default=5000, help='Rows read and flushed per chunk')
+    parser.add_argument('--max-ops', type=int, default=500, help='Maximum write operations per second')
+    parser.add_argument('--update-daily', action='store_true',
+                        help='Also write per-date sales_daily totals (sales only)')
+    args = parser.parse_args()
+
+    if args.update_daily and args.type != 'sales':
+        logger.warning("--update-daily only applies to sales data; ignoring")
+
+    bridge = AnalyticsBridge()
+    if not bridge.initialize_firebase():
+        return 1
+
+    ingestor = BulkIngestor(
+        bridge.db,
+        args.type,
+        chunk_size=args.chunk_size,
+        max_ops_per_second=args.max_ops,
+        update_daily=args.update_daily
+    )
+    overrides = parse_mapping(args.map)
+
+    success = all([ingestor.ingest(path, overrides) for path in args.files])
+
+    if success:
+        logger.info("Bulk ingest completed successfully")
+        return 0
+    else:
+        logger.error("Bulk ingest failed")
+        return 1
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,323 @@
+#!/usr/bin/env python3
+"""
+Demand Forecast - Phase 4
+Batched demand forecasting for every menu item at once.
+Builds a day x item demand matrix from sales_data, fits additive Holt-Winters
+models to all items together with vectorized NumPy operations, and writes the
+forecasts to the prediction_history collection read by the dashboard charts.
+"""
+
+import re
+import time
+import hashlib
+import logging
+import argparse
+from typing import Dict, List, Any, Optional, Tuple
+import numpy as np
+import pandas as pd
+from dotenv import load_dotenv
+
+from firebase_admin import firestore
+
+load_dotenv()
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+# Firestore rejects batches with more than 500 operations
+FIRESTORE_BATCH_LIMIT = 500
+
+# Smoothing parameter grid searched per item (alpha, beta, gamma)
+HW_PARAM_GRID = [
+    (alpha, beta, gamma)
+    for alpha in (0.1, 0.3, 0.5)
+    for beta in (0.0, 0.05)
+    for gamma in (0.05, 0.2)
+]
+
+
+class DemandForecaster:
+    """Vectorized demand forecasting over the day x item sales matrix"""
+
+    def __init__(self, db=None, horizon: int = 7, season_length: int = 7):
+        self.db = db
+        self.horizon = horizon
+        self.season_length = season_length
+
+    def build_demand_matrix(self, sales_df: pd.DataFrame) -> Tuple[pd.DatetimeIndex, List[str], np.ndarray, np.ndarray]:
+        """Pivot sales rows into day x item matrices of units sold and revenue"""
+        df = sales_df.dropna(subset=['date', 'itemName'])
+        df = df.assign(date=df['date'].dt.normalize())
+
+        grouped = df.groupby(['date', 'itemName'])['amount'].agg(['size', 'sum'])
+
+        # Reindex to a continuous calendar so days without sales count as zero demand
+        days = pd.date_range(grouped.index.get_level_values(0).min(),
+                             grouped.index.get_level_values(0).max(), freq='D')
+        demand = grouped['size'].unstack(fill_value=0).reindex(days, fill_value=0)
+        revenue = grouped['sum'].unstack(fill_value=0).reindex(days, fill_value=0)
+
+        items = [str(item) for item in demand.columns]
+        return days, items, demand.to_numpy(dtype=np.float64), revenue.to_numpy(dtype=np.float64)
+
+    def _holt_winters(self, y: np.ndarray, params: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Run additive Holt-Winters for every (parameter set, item) pair at once.
+        y is (days, items); params is (grid, 3). Returns the in-sample SSE as
+        (grid, items) and the h-step forecasts as (grid, horizon, items).
+        """
+        m = self.season_length
+        n_days, n_items = y.shape
+        alpha = params[:, 0:1]
+        beta = params[:, 1:2]
+        gamma = params[:, 2:3]
+
+        # Initial state from the first season, broadcast across the grid
+        level = np.broadcast_to(y[:m].mean(axis=0), (len(params), n_items)).copy()
+        trend = np.broadcast_to((y[m:2 * m].mean(axis=0) - y[:m].mean(axis=0)) / m,
+                                (len(params), n_items)).copy()
+        season = np.broadcast_to(y[:m] - y[:m].mean(axis=0), (len(params), m, n_items)).copy()
+        sse = np.zeros((len(params), n_items))
+
+        for t in range(m, n_days):
+            s_idx = t % m
+            s_prev = season[:, s_idx, :]
+            error = y[t] - (level + trend + s_prev)
+            sse += error * error
+
+            new_level = alpha * (y[t] - s_prev) + (1 - alpha) * (level + trend)
+            trend = beta * (new_level - level) + (1 - beta) * trend
+            season[:, s_idx, :] = gamma * (y[t] - new_level) + (1 - gamma) * s_prev
+            level = new_level
+
+        steps = np.arange(1, self.horizon + 1)
+        season_idx = (n_days + steps - 1) % m
+        forecasts = level[:, None, :] + steps[None, :, None] * trend[:, None, :] + season[:, season_idx, :]
+        return sse, forecasts
+
+    def forecast(self, demand: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Forecast the next horizon days for every item column of the demand matrix.
+        Items with at least two full seasons use the best Holt-Winters fit from the
+        parameter grid; shorter histories fall back to seasonal-naive.
+        Returns (forecasts of shape (horizon, items), model name per item).
+        """
+        n_days, n_items = demand.shape
+        m = self.season_length
+
+        # Seasonal-naive: repeat the last observed season
+        if n_days >= m:
+            naive = demand[-m:][np.arange(self.horizon) % m]
+        else:
+            naive = np.broadcast_to(demand.mean(axis=0), (self.horizon, n_items))
+
+        if n_days < 2 * m:
+            return np.clip(naive, 0, None), np.full(n_items, 'seasonal_naive', dtype=object)
+
+        params = np.asarray(HW_PARAM_GRID, dtype=np.float64)
+        sse, hw_forecasts = self._holt_winters(demand, params)
+
+        # Pick the lowest in-sample error parameter set per item
+        best = sse.argmin(axis=0)
+        forecasts = hw_forecasts[best, :, np.arange(n_items)].T
+
+        # Guard against diverged fits
+        invalid = ~np.isfinite(forecasts).all(axis=0)
+        forecasts[:, invalid] = naive[:, invalid]
+
+        models = np.full(n_items, 'holt_winters', dtype=object)
+        models[invalid] = 'seasonal_naive'
+        return np.clip(forecasts, 0, None), models
+
+    def backtest(self, demand: np.ndarray, revenue: np.ndarray, unit_price: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Forecast the last horizon days from the history before them, for forecast vs actual"""
+        holdout = min(self.horizon, max(demand.shape[0] - self.season_length, 0))
+        if holdout == 0:
+            return np.empty(0), np.empty(0)
+
+        forecaster = DemandForecaster(horizon=holdout, season_length=self.season_length)
+        predicted_demand, _ = forecaster.forecast(demand[:-holdout])
+        predicted_sales = (predicted_demand * unit_price).sum(axis=1)
+        actual_sales = revenue[-holdout:].sum(axis=1)
+        return predicted_sales, actual_sales
+
+    @staticmethod
+    def _unit_price(demand: np.ndarray, revenue: np.ndarray, window: int = 28) -> np.ndarray:
+        """Average revenue per unit over the recent window, per item"""
+        units = demand[-window:].sum(axis=0)
+        sales = revenue[-window:].sum(axis=0)
+        return np.divide(sales, units, out=np.zeros_like(sales), where=units > 0)
+
+    @staticmethod
+    def _item_doc_id(item_name: str) -> str:
+        """Stable document ID so reruns overwrite instead of duplicating"""
+        slug = re.sub(r'[^A-Za-z0-9_-]+', '_', item_name).strip('_')[:100]
+        digest = hashlib.md5(item_name.encode('utf-8')).hexdigest()[:8]
+        return f"item_{slug}_{digest}"
+
+    def build_prediction_docs(self, days: pd.DatetimeIndex, items: List[str],
+                              demand: np.ndarray, revenue: np.ndarray,
+                              today: Optional[pd.Timestamp] = None) -> List[Tuple[str, Dict[str, Any]]]:
+        """Turn forecasts into prediction_history documents keyed by stable IDs"""
+        today = (today or pd.Timestamp.now()).normalize()
+        unit_price = self._unit_price(demand, revenue)
+
+        # Anchor the forecast window to today; if sales history is stale, forecast
+        # through the gap and keep only the days from today onwards
+        gap = max((today - days[-1]).days - 1, 0)
+        if gap:
+            logger.warning(f"Sales history ends {days[-1].strftime('%Y-%m-%d')}, {gap} days before today; "
+                           f"forecasting through the gap")
+        forecaster = DemandForecaster(horizon=gap + self.horizon, season_length=self.season_length)
+        forecasts, models = forecaster.forecast(demand)
+        forecasts = forecasts[gap:]
+
+        future_days = pd.date_range(days[-1] + pd.Timedelta(days=gap + 1), periods=self.horizon, freq='D')
+        future_labels = [d.strftime('%Y-%m-%d') for d in future_days]
+        daily_sales = (forecasts * unit_price).sum(axis=1)
+
+        docs = []
+
+        # Per-date totals: read by the predicted sales and forecast vs actual charts
+        predicted_past, actual_past = self.backtest(demand, revenue, unit_price)
+        past_labels = [d.strftime('%Y-%m-%d') for d in days[len(days) - len(predicted_past):]]
+        for label, predicted, actual in zip(past_labels, predicted_past, actual_past):
+            docs.append((f"sales_{label}", {
+                'date': label,
+                'predictedSales': round(float(predicted), 2),
+                'actualSales': round(float(actual), 2),
+                'type': 'backtest'
+            }))
+
+        for label, predicted in zip(future_labels, daily_sales):
+            docs.append((f"sales_{label}", {
+                'date': label,
+                'predictedSales': round(float(predicted), 2),
+                'type': 'forecast'
+            }))
+
+        # Per-item totals over the horizon: read by the menu demand chart.
+        # These have no 'date' field so they stay out of the date-ordered queries.
+        total_demand = forecasts.sum(axis=0)
+        for idx, item in enumerate(items):
+            docs.append((self._item_doc_id(item), {
+                'itemName': item,
+                'predictedDemand': round(float(total_demand[idx]), 2),
+                'dailyDemand': [round(float(v), 2) for v in forecasts[:, idx]],
+                'forecastStart': future_labels[0],
+                'forecastEnd': future_labels[-1],
+                'horizonDays': self.horizon,
+                'model': models[idx],
+                'type': 'item_forecast'
+            }))
+
+        return docs
+
+    def _stale_item_doc_ids(self, current_ids: set) -> List[str]:
+        """IDs of item forecasts from earlier runs for items not forecast in this run"""
+        query = self.db.collection('prediction_history').where('type', '==', 'item_forecast')
+        return [doc.id for doc in query.stream() if doc.id not in current_ids]
+
+    def save_predictions(self, docs: List[Tuple[str, Dict[str, Any]]]) -> bool:
+        """
+        Write prediction documents to Firestore in batches of at most 500 operations,
+        deleting item forecasts for items that dropped out of the sales window
+        """
+        try:
+            collection = self.db.collection('prediction_history')
+            stale_ids = self._stale_item_doc_ids({doc_id for doc_id, _ in docs})
+            ops = [(doc_id, data) for doc_id, data in docs] + [(doc_id, None) for doc_id in stale_ids]
+
+            for start in range(0, len(ops), FIRESTORE_BATCH_LIMIT):
+                batch = self.db.batch()
+                for doc_id, data in ops[start:start + FIRESTORE_BATCH_LIMIT]:
+                    if data is None:
+                        batch.delete(collection.document(doc_id))
+                    else:
+                        batch.set(collection.document(doc_id), {**data, 'createdAt': firestore.SERVER_TIMESTAMP})
+                batch.commit()
+
+            logger.info(f"Saved {len(docs)} prediction documents to prediction_history, "
+                        f"removed {len(stale_ids)} stale item forecasts")
+            return True
+
+        except Exception as e:
+            logger.error(f"Error saving predictions: {str(e)}")
+            return False
+
+    def run(self, sales_df: pd.DataFrame) -> bool:
+        """Forecast demand for all items in sales_df and persist the results"""
+        if sales_df is None or sales_df.empty:
+            logger.error("Sales data not available for forecasting")
+            return False
+
+        try:
+            days, items, demand, revenue = self.build_demand_matrix(sales_df)
+        except Exception as e:
+            logger.error(f"Error building demand matrix: {str(e)}")
+            return False
+
+        if not items:
+            logger.warning("No menu items found for forecasting")
+            return False
+
+        start = time.perf_counter()
+        docs = self.build_prediction_docs(days, items, demand, revenue)
+        logger.info(f"Forecast {len(items)} items over {len(days)} days in {time.perf_counter() - start:.2f}s")
+
+        return self.save_predictions(docs)
+
+
+def benchmark(n_items: int = 5000, n_days: int = 180, seed: int = 0) -> float:
+    """Time the forecasting step on a synthetic day x item demand matrix"""
+    rng = np.random.default_rng(seed)
+    weekly = 1 + 0.3 * np.sin(2 * np.pi * np.arange(n_days) / 7)
+    base = rng.uniform(5, 50, size=n_items)
+    demand = rng.poisson(weekly[:, None] * base[None, :]).astype(np.float64)
+
+    forecaster = DemandForecaster()
+    start = time.perf_counter()
+    forecaster.forecast(demand)
+    elapsed = time.perf_counter() - start
+
+    logger.info(f"Benchmark: forecast {n_items} items x {n_days} days "
+                f"({len(HW_PARAM_GRID)} parameter sets) in {elapsed:.2f}s")
+    return elapsed
+
+
+def main():
+    """Main entry point"""
+    parser = argparse.ArgumentParser(description='Forecast menu item demand into prediction_history')
+    parser.add_argument('--days', type=int, default=90, help='Days of sales history to fit on')
+    parser.add_argument('--horizon', type=int, default=7, help='Days to forecast ahead')
+    parser.add_argument('--benchmark', action='store_true', help='Run the synthetic benchmark and exit')
+    parser.add_argument('--items', type=int, default=5000, help='Items in the benchmark matrix')
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark(n_items=args.items, n_days=max(args.days, 14))
+        return 0
+
+    # Imported here to reuse Firebase setup and fetching without a circular import
+    from analytics_bridge import AnalyticsBridge
+
+    bridge = AnalyticsBridge()
+    if not bridge.initialize_firebase():
+        return 1
+
+    sales_df = bridge.fetch_sales_data(args.days)
+    success = DemandForecaster(bridge.db, horizon=args.horizon).run(sales_df)
+
+    if success:
+        logger.info("Demand forecast completed successfully")
+        return 0
+    else:
+        logger.error("Demand forecast failed")
+        return 1
+
+
+if __name__ == "__main__":
+    exit(main())
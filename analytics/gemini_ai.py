@@ -6,7 +6,9 @@ Generates AI-driven business recommendations based on data trends
 """
 
 import os
+import re
 import json
+import heapq
 import logging
 from datetime import datetime
 from typing import Dict, List, Any, Optional
@@ -38,15 +40,106 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Trends whose cost and sales change percentages both differ by at most this many points are merged
+TREND_MERGE_TOLERANCE = 5.0
+
+# Priority weights used to rank trends for the prompt
+SEVERITY_WEIGHTS = {
+    'high': 3.0,
+    'opportunity': 2.0,
+    'medium': 1.5
+}
+
+PROMPT_HEADER = """As a restaurant business consultant, analyze these market trends and provide strategic recommendations:
+
+TRENDS IDENTIFIED:
+"""
+
+PROMPT_FOOTER = """
+
+Based on these trends, provide ONE actionable business recommendation for a restaurant owner. 
+
+Your response should be structured as:
+1. **Insight**: Brief explanation of the trend impact (1-2 sentences)
+2. **Recommended Action**: Specific, actionable step the owner should take (1-2 sentences)
+3. **Expected Outcome**: What positive result to expect from this action (1 sentence)
+
+Keep your response concise, practical, and focused on immediate actionable steps."""
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Cheap local token estimate, no tokenizer call: roughly one token per word
+    plus one per punctuation mark, and never fewer than len/4
+    """
+    pieces = len(re.findall(r"\w+|[^\w\s]", text))
+    return max(pieces, (len(text) + 3) // 4)
+
+
+def trend_priority(trend: Dict[str, Any]) -> float:
+    """Rank trends by severity x correlation strength"""
+    weight = SEVERITY_WEIGHTS.get(trend.get('severity', 'medium'), 1.0)
+    try:
+        strength = float(trend.get('correlation_strength', 0.5))
+    except (TypeError, ValueError):
+        strength = 0.5
+    return weight * strength
+
+
+def _change_percents(trend: Dict[str, Any]) -> Optional[tuple]:
+    """(cost change %, sales change %) of a trend, or None if it does not carry them"""
+    try:
+        return float(trend['cost_change_percent']), float(trend['sales_change_percent'])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def merge_similar_trends(trends: List[Dict[str, Any]],
+                         tolerance: float = TREND_MERGE_TOLERANCE) -> List[Dict[str, Any]]:
+    """
+    Collapse near-duplicate trends. Trends with the same severity and direction
+    of cost and sales change whose change percentages are each within tolerance
+    points of a higher-priority trend are folded into it; trends without change
+    percentages (older processed_stats) only merge with the same ingredient name.
+    Each kept trend records merged_count and the names it stands for.
+    """
+    clusters: Dict[tuple, List[Dict[str, Any]]] = {}
+    for trend in sorted(trends, key=trend_priority, reverse=True):
+        ingredient = ' '.join(str(trend.get('ingredient', '')).lower().split())
+        changes = _change_percents(trend)
+        if changes is None:
+            key = ('name', ingredient or trend.get('trend', ''), trend.get('severity', 'medium'))
+        else:
+            key = ('change', trend.get('severity', 'medium'), changes[0] > 0, changes[1] > 0)
+
+        group = clusters.setdefault(key, [])
+        for kept in group:
+            kept_changes = _change_percents(kept)
+            if changes is None or (abs(changes[0] - kept_changes[0]) <= tolerance
+                                   and abs(changes[1] - kept_changes[1]) <= tolerance):
+                kept['merged_count'] += 1
+                name = ' '.join(str(trend.get('ingredient', '')).split())
+                seen = {n.lower() for n in kept['merged_ingredients']}
+                seen.add(' '.join(str(kept.get('ingredient', '')).lower().split()))
+                if name and name.lower() not in seen:
+                    kept['merged_ingredients'].append(name)
+                break
+        else:
+            group.append({**trend, 'merged_count': 1, 'merged_ingredients': []})
+
+    return [kept for group in clusters.values() for kept in group]
+
 
 class GeminiAI:
     """Gemini AI integration for business recommendations"""
     
-    def __init__(self):
+    def __init__(self, prompt_token_budget: Optional[int] = None, max_prompt_trends: Optional[int] = None):
         self.db = None
         self.model = None
         self.use_vertex = VERTEX_AI_AVAILABLE
         self.use_genai = GENAI_AVAILABLE
+        self.prompt_token_budget = prompt_token_budget or int(os.getenv('GEMINI_PROMPT_TOKEN_BUDGET', 800))
+        self.max_prompt_trends = max_prompt_trends or int(os.getenv('GEMINI_MAX_PROMPT_TRENDS', 20))
         
     def initialize(self) -> bool:
         """Initialize Firebase and AI models"""
@@ -119,35 +212,44 @@ class GeminiAI:
             provide one actionable business recommendation for a restaurant owner 
             to improve profitability and operational efficiency."""
         
-        # Build trend summary
+        # Merge near-duplicates, then keep the top-K by priority
+        candidates = merge_similar_trends(trends)
+        ranked = heapq.nlargest(self.max_prompt_trends, candidates, key=trend_priority)
+        
+        # Fill the token budget with the highest-priority trends first
+        budget = self.prompt_token_budget - estimate_tokens(PROMPT_HEADER) - estimate_tokens(PROMPT_FOOTER)
         trend_summaries = []
-        for trend in trends:
+        used_tokens = 0
+        for trend in ranked:
             trend_text = trend.get('trend', '')
             severity = trend.get('severity', 'medium')
-            ingredient = trend.get('ingredient', 'Unknown')
             
             if severity == 'high':
-                trend_summaries.append(f"URGENT: {trend_text}")
+                line = f"URGENT: {trend_text}"
             elif severity == 'opportunity':
-                trend_summaries.append(f"OPPORTUNITY: {trend_text}")
+                line = f"OPPORTUNITY: {trend_text}"
             else:
-                trend_summaries.append(f"TREND: {trend_text}")
+                line = f"TREND: {trend_text}"
+            
+            if trend.get('merged_count', 1) > 1:
+                similar = trend.get('merged_ingredients', [])
+                line += f" (+{trend['merged_count'] - 1} similar" + (f": {', '.join(similar)})" if similar else ")")
+            
+            line_tokens = estimate_tokens(line) + 1
+            if used_tokens + line_tokens > budget and trend_summaries:
+                break
+            trend_summaries.append(line)
+            used_tokens += line_tokens
+        
+        dropped = len(trends) - sum(t.get('merged_count', 1) for t in ranked[:len(trend_summaries)])
+        if dropped or len(candidates) < len(trends):
+            logger.info(f"Prompt compaction: kept {len(trend_summaries)} of {len(trends)} trends "
+                        f"({len(trends) - len(candidates)} merged as duplicates, "
+                        f"{dropped} not represented), ~{used_tokens} trend tokens of {budget} budget")
         
         trends_text = "\n".join(trend_summaries)
         
-        prompt = f"""As a restaurant business consultant, analyze these market trends and provide strategic recommendations:
-
-TRENDS IDENTIFIED:
-{trends_text}
-
-Based on these trends, provide ONE actionable business recommendation for a restaurant owner. 
-
-Your response should be structured as:
-1. **Insight**: Brief explanation of the trend impact (1-2 sentences)
-2. **Recommended Action**: Specific, actionable step the owner should take (1-2 sentences)
-3. **Expected Outcome**: What positive result to expect from this action (1 sentence)
-
-Keep your response concise, practical, and focused on immediate actionable steps."""
+        prompt = f"{PROMPT_HEADER}{trends_text}{PROMPT_FOOTER}"
 
         return prompt
     
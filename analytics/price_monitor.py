@@ -0,0 +1,399 @@
+#!/usr/bin/env python3
+"""
+Price Monitor - Phase 3 (streaming)
+Online anomaly detection for ingredient price spikes.
+Keeps an exponentially weighted mean/variance and two-sided CUSUM state per
+ingredient, updates it in O(1) for each new market_historical_data row, and
+raises a spike alert into recommendations as soon as a threshold is crossed,
+without re-scanning history or waiting for the batch analytics run.
+"""
+
+import os
+import math
+import time
+import array
+import logging
+import argparse
+import threading
+from datetime import date, datetime, timezone
+from typing import Dict, List, Any, Optional
+import numpy as np
+from dotenv import load_dotenv
+
+from firebase_admin import firestore
+
+from analytics_bridge import AnalyticsBridge
+
+load_dotenv()
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+
+class PriceStateStore:
+    """Compact per-ingredient detector state: one contiguous double array per field"""
+
+    # Committed daily statistics, the running aggregate of the latest day, and alerting state.
+    # Days are stored as proleptic Gregorian ordinals.
+    FIELDS = ('mean', 'var', 'cusum_pos', 'cusum_neg', 'count',
+              'last_day', 'day_sum', 'day_count', 'last_alert_day', 'armed')
+
+    def __init__(self):
+        self.index: Dict[str, int] = {}
+        self.names: List[str] = []
+        # createdAt (epoch seconds) of the last market row folded into the state
+        self.last_created_at: float = 0.0
+        for field in self.FIELDS:
+            setattr(self, field, array.array('d'))
+
+    def slot(self, ingredient: str) -> int:
+        """Return the state slot for an ingredient, allocating one on first sight"""
+        idx = self.index.get(ingredient)
+        if idx is None:
+            idx = len(self.names)
+            self.index[ingredient] = idx
+            self.names.append(ingredient)
+            for field in self.FIELDS:
+                getattr(self, field).append(1.0 if field == 'armed' else 0.0)
+        return idx
+
+    def save(self, path: str) -> None:
+        """Atomically persist the store as a compressed NumPy archive"""
+        tmp_path = path + '.tmp.npz'
+        np.savez_compressed(
+            tmp_path,
+            names=np.array(self.names, dtype=str),
+            last_created_at=np.array(self.last_created_at),
+            **{field: np.frombuffer(getattr(self, field), dtype=np.float64) for field in self.FIELDS}
+        )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> 'PriceStateStore':
+        """Load a store saved by save(), or return an empty one if none exists"""
+        store = cls()
+        if not os.path.exists(path):
+            return store
+
+        with np.load(path) as data:
+            store.names = [str(name) for name in data['names']]
+            store.index = {name: idx for idx, name in enumerate(store.names)}
+            if 'last_created_at' in data:
+                store.last_created_at = float(data['last_created_at'])
+            for field in cls.FIELDS:
+                if field in data:
+                    setattr(store, field, array.array('d', data[field].tobytes()))
+                else:
+                    default = 1.0 if field == 'armed' else 0.0
+                    setattr(store, field, array.array('d', [default] * len(store.names)))
+
+        logger.info(f"Loaded price monitor state for {len(store.names)} ingredients")
+        return store
+
+
+def day_number(value: Any) -> Optional[int]:
+    """Ordinal day of a row date (YYYY-MM-DD string or datetime), None if missing or invalid"""
+    if isinstance(value, datetime):
+        return value.date().toordinal()
+    if isinstance(value, str):
+        try:
+            return date.fromisoformat(value.strip()[:10]).toordinal()
+        except ValueError:
+            return None
+    return None
+
+
+class PriceSpikeDetector:
+    """
+    EWMA z-score and CUSUM spike detection over a PriceStateStore.
+    Each ingredient contributes one observation per day: the average of that
+    day's rows. The running day average is checked against the committed state
+    on every row, so alerts fire immediately; it is folded into the EW
+    statistics when a later day arrives. Rows older than the latest day are skipped.
+    """
+
+    def __init__(self, store: PriceStateStore, alpha: float = 0.1, variance_alpha: float = 0.03,
+                 z_threshold: float = 6.0, cusum_k: float = 1.0, cusum_h: float = 8.0, min_observations: int = 20,
+                 min_relative_std: float = 0.01, cooldown_days: int = 7, rearm_z: float = 2.0):
+        self.store = store
+        self.alpha = alpha
+        # A slower variance average keeps the z-score denominator from collapsing on quiet stretches
+        self.variance_alpha = variance_alpha
+        self.z_threshold = z_threshold
+        self.cusum_k = cusum_k
+        self.cusum_h = cusum_h
+        self.min_observations = min_observations
+        # Floors the std so perfectly flat price histories do not produce infinite z-scores
+        self.min_relative_std = min_relative_std
+        # After an alert, stay quiet for cooldown_days and until the z-score falls below rearm_z
+        self.cooldown_days = cooldown_days
+        self.rearm_z = rearm_z
+        self.skipped_stale = 0
+
+    def _z_score(self, i: int, value: float) -> float:
+        s = self.store
+        mean = s.mean[i]
+        # Bias-correct the EW variance, which starts at zero and is underestimated early on
+        weight = 1 - (1 - self.variance_alpha) ** max(s.count[i] - 1, 1)
+        std = max(math.sqrt(s.var[i] / weight), self.min_relative_std * abs(mean), 1e-9)
+        return (value - mean) / std
+
+    def _commit_day(self, i: int) -> None:
+        """Fold the finished day's average price into the EW statistics"""
+        s = self.store
+        value = s.day_sum[i] / s.day_count[i]
+        count = s.count[i]
+
+        if count == 0:
+            s.mean[i] = value
+            s.count[i] = 1
+            return
+
+        z = self._z_score(i, value)
+
+        # Re-arm once the price has settled back near its (adapting) average
+        if not s.armed[i] and abs(z) < self.rearm_z:
+            s.armed[i] = 1.0
+
+        # CUSUM only accumulates once the variance estimate has warmed up, and
+        # restarts from zero when a disarmed ingredient re-arms
+        if count >= self.min_observations and s.armed[i]:
+            s.cusum_pos[i] = max(0.0, s.cusum_pos[i] + z - self.cusum_k)
+            s.cusum_neg[i] = max(0.0, s.cusum_neg[i] - z - self.cusum_k)
+
+        # Exponentially weighted mean and variance
+        diff = value - s.mean[i]
+        s.mean[i] += self.alpha * diff
+        s.var[i] = (1 - self.variance_alpha) * (s.var[i] + self.variance_alpha * diff * diff)
+        s.count[i] = count + 1
+
+    def update(self, ingredient: str, price: float, day: int,
+               alerts_enabled: bool = True) -> Optional[Dict[str, Any]]:
+        """Fold one price row into the ingredient's state; return an alert if one fires"""
+        s = self.store
+        i = s.slot(ingredient)
+
+        if s.day_count[i] == 0:
+            s.last_day[i] = day
+        elif day < s.last_day[i]:
+            self.skipped_stale += 1
+            return None
+        elif day > s.last_day[i]:
+            self._commit_day(i)
+            s.last_day[i] = day
+            s.day_sum[i] = 0.0
+            s.day_count[i] = 0
+
+        s.day_sum[i] += price
+        s.day_count[i] += 1
+
+        if s.count[i] < self.min_observations or not s.armed[i]:
+            return None
+        if day - s.last_alert_day[i] < self.cooldown_days:
+            return None
+
+        value = s.day_sum[i] / s.day_count[i]
+        z = self._z_score(i, value)
+        cusum_pos = max(0.0, s.cusum_pos[i] + z - self.cusum_k)
+        cusum_neg = max(0.0, s.cusum_neg[i] - z - self.cusum_k)
+
+        if abs(z) >= self.z_threshold:
+            reason = 'jump'
+        elif cusum_pos > self.cusum_h or cusum_neg > self.cusum_h:
+            reason = 'drift'
+        else:
+            return None
+
+        # Backfilled rows go through the same disarm/cooldown bookkeeping without
+        # emitting, so detections on history never carry over into live alerts
+        mean = s.mean[i]
+        s.armed[i] = 0.0
+        s.last_alert_day[i] = day
+        s.cusum_pos[i] = s.cusum_neg[i] = 0.0
+        if not alerts_enabled:
+            return None
+        return {
+            'ingredient': ingredient,
+            'price': value,
+            'expected': mean,
+            'z_score': z,
+            'change_percent': (value - mean) / mean * 100 if mean else 0.0,
+            'direction': 'up' if value > mean else 'down',
+            'reason': reason
+        }
+
+
+class PriceMonitor:
+    """Listens for new market_historical_data rows and raises spike alerts"""
+
+    def __init__(self, db, detector: PriceSpikeDetector, state_path: str, max_alert_age_days: int = 2):
+        self.db = db
+        self.detector = detector
+        self.state_path = state_path
+        self.max_alert_age_days = max_alert_age_days
+        self._lock = threading.Lock()
+
+    def build_recommendation(self, alert: Dict[str, Any]) -> Dict[str, Any]:
+        """Shape an alert like the trend alerts written by AnalyticsBridge"""
+        ingredient = alert['ingredient']
+        change = abs(alert['change_percent'])
+        prices = f"({alert['price']:.2f} vs {alert['expected']:.2f})"
+        up = alert['direction'] == 'up'
+
+        if alert['reason'] == 'jump':
+            insight = f"{ingredient} price {'spiked' if up else 'dropped'} {change:.1f}% {'above' if up else 'below'} its recent average {prices}"
+        else:
+            insight = f"{ingredient} price has been drifting {'up' if up else 'down'}, now {change:.1f}% {'above' if up else 'below'} its recent average {prices}"
+
+        if up:
+            severity = 'high'
+            action = f"Check {ingredient} supplier pricing before the next order and review menu items that depend on it."
+        else:
+            severity = 'opportunity'
+            action = f"Consider buying {ingredient} ahead while prices are low."
+
+        return {
+            'title': f"Price {'Spike' if up else 'Drop'}: {ingredient}",
+            'insight': insight,
+            'suggestedAction': action,
+            'severity': severity,
+            'ingredient': ingredient,
+            'zScore': round(alert['z_score'], 2),
+            'detectionReason': alert['reason'],
+            'createdAt': firestore.SERVER_TIMESTAMP,
+            'read': False,
+            'icon': '⚠️' if severity == 'high' else '💡',
+            'type': 'price_spike'
+        }
+
+    def process_row(self, row: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Update state for one market row and save a recommendation if it alerts"""
+        ingredient = row.get('ingredientName')
+        day = day_number(row.get('date'))
+        try:
+            price = float(row.get('amount'))
+        except (TypeError, ValueError):
+            return None
+        # formatAmount stores 0 for unparseable input, so non-positive prices are not real quotes
+        if not ingredient or day is None or not math.isfinite(price) or price <= 0:
+            return None
+
+        # Backfilled history still trains the state but does not raise alerts
+        recent = day >= date.today().toordinal() - self.max_alert_age_days
+
+        with self._lock:
+            alert = self.detector.update(str(ingredient), price, day, alerts_enabled=recent)
+            created_at = row.get('createdAt')
+            if isinstance(created_at, datetime):
+                self.detector.store.last_created_at = max(self.detector.store.last_created_at,
+                                                          created_at.timestamp())
+
+        if alert:
+            try:
+                rec_ref = self.db.collection('recommendations').document()
+                rec_ref.set(self.build_recommendation(alert))
+                logger.info(f"Price spike alert for {ingredient}: {rec_ref.id}")
+            except Exception as e:
+                logger.error(f"Error saving price spike alert: {str(e)}")
+
+        return alert
+
+    def flush(self) -> None:
+        """Persist detector state together with the createdAt resume point"""
+        with self._lock:
+            self.detector.store.save(self.state_path)
+
+    def _on_snapshot(self, _snapshot, changes, _read_time) -> None:
+        rows = [change.document.to_dict() for change in changes if change.type.name == 'ADDED']
+        if not rows:
+            return
+
+        rows.sort(key=lambda row: (str(row.get('date') or ''), row.get('createdAt') or datetime.min.replace(tzinfo=timezone.utc)))
+        for row in rows:
+            self.process_row(row)
+
+        # Save after every delivered batch so a restart resumes exactly after it
+        self.flush()
+
+    def listen(self) -> None:
+        """Stream rows created after the persisted resume point (or now, on first run) until interrupted"""
+        store = self.detector.store
+        if store.last_created_at:
+            start = datetime.fromtimestamp(store.last_created_at, tz=timezone.utc)
+            logger.info(f"Resuming from rows created after {start.isoformat()}")
+        else:
+            start = datetime.now(timezone.utc)
+
+        query = self.db.collection('market_historical_data').where('createdAt', '>', start)
+        watch = query.on_snapshot(self._on_snapshot)
+        logger.info("Listening for new market_historical_data rows...")
+
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            logger.info("Stopping price monitor")
+        finally:
+            watch.unsubscribe()
+            self.flush()
+            if self.detector.skipped_stale:
+                logger.info(f"Skipped {self.detector.skipped_stale} rows older than their ingredient's latest day")
+
+
+def benchmark(n_ingredients: int = 5000, n_days: int = 100, seed: int = 0) -> float:
+    """Measure detector updates per second and false alerts on a stationary daily price stream"""
+    rng = np.random.default_rng(seed)
+    names = [f"ingredient_{i}" for i in range(n_ingredients)]
+    base = rng.uniform(1, 100, size=n_ingredients)
+    prices = (base[None, :] * rng.lognormal(0, 0.05, size=(n_days, n_ingredients))).tolist()
+    first_day = date(2025, 1, 1).toordinal()
+
+    detector = PriceSpikeDetector(PriceStateStore())
+    alerts = 0
+    start = time.perf_counter()
+    for offset, day_prices in enumerate(prices):
+        day = first_day + offset
+        for ingredient, price in zip(names, day_prices):
+            if detector.update(ingredient, price, day):
+                alerts += 1
+    elapsed = time.perf_counter() - start
+
+    n_updates = n_days * n_ingredients
+    logger.info(f"Benchmark: {n_updates} updates across {n_ingredients} ingredients in {elapsed:.2f}s "
+                f"({n_updates / elapsed:,.0f} updates/s, {alerts} false alerts on a stationary stream)")
+    return n_updates / elapsed
+
+
+def main():
+    """Main entry point"""
+    parser = argparse.ArgumentParser(description='Stream ingredient prices and alert on spikes')
+    parser.add_argument('--state', default='price_monitor_state.npz', help='Path of the persisted detector state')
+    parser.add_argument('--z-threshold', type=float, default=6.0, help='Instant spike threshold in EW standard deviations')
+    parser.add_argument('--cusum-h', type=float, default=8.0, help='CUSUM decision threshold')
+    parser.add_argument('--cooldown-days', type=int, default=7, help='Minimum days between alerts for one ingredient')
+    parser.add_argument('--benchmark', action='store_true', help='Run the synthetic benchmark and exit')
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark()
+        return 0
+
+    bridge = AnalyticsBridge()
+    if not bridge.initialize_firebase():
+        return 1
+
+    detector = PriceSpikeDetector(
+        PriceStateStore.load(args.state),
+        z_threshold=args.z_threshold,
+        cusum_h=args.cusum_h,
+        cooldown_days=args.cooldown_days
+    )
+    PriceMonitor(bridge.db, detector, args.state).listen()
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -327,7 +327,8 @@
     var collections = [
       'transactions', 'products', 'expenses', 
       'sales_data', 'market_historical_data', 
-      'recommendations', 'processed_stats', 'prediction_history'
+      'recommendations', 'processed_stats', 'prediction_history',
+      'sales_daily'
     ];
 
     var promises = collections.map(function(collectionName) {